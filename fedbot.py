@@ -1,15 +1,25 @@
+import asyncio
 import logging
+import warnings
 import os
 import sqlite3
-from datetime import datetime
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from functools import partial
+import aiosqlite
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, CallbackContext, MessageHandler, Filters
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, CallbackQueryHandler, ContextTypes, ConversationHandler, MessageHandler, TypeHandler, filters
+from telegram.constants import MessageLimit
 from telegram.error import TelegramError
-from dotenv import load_dotenv
+from telegram.warnings import PTBUserWarning
 import sys
 
-# Load environment variables from .env file
-load_dotenv()
+# Load environment variables from .env file only when USE_DOTENV=1 (local
+# development), once per process; deployments export the variables directly
+if os.environ.get('USE_DOTENV', '0') == '1' and not os.environ.get('_DOTENV_LOADED'):
+    from dotenv import load_dotenv
+    load_dotenv()
+    os.environ['_DOTENV_LOADED'] = '1'
 
 # Configure logging
 logging.basicConfig(
@@ -19,24 +29,63 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- CONFIG ---
-try:
-    BOT_TOKEN = os.getenv('BOT_TOKEN')
-    ADMIN_ID = int(os.getenv('ADMIN_ID', 0))
-    DB_PATH = os.getenv('DB_PATH', 'appeals.db')
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Bot configuration, read from the environment once at startup"""
+    BOT_TOKEN: str
+    ADMIN_ID: int
+    DB_PATH: str
+    USE_POLLING: bool
+    PUBLIC_HOST: str | None
+    WEBHOOK_SECRET: str | None
+    PORT: int
+
+def _load():
+    """Build the Config from environment variables"""
+    environ = os.environ
+    bot_token = environ.get('BOT_TOKEN')
+    admin_id = int(environ.get('ADMIN_ID', 0))
+    db_path = environ.get('DB_PATH', 'appeals.db')
+    use_polling = environ.get('USE_POLLING', '0') == '1'
+    public_host = environ.get('PUBLIC_HOST')
+    webhook_secret = environ.get('WEBHOOK_SECRET')
+    port = int(environ.get('PORT', 8443))
     
-    if not BOT_TOKEN:
+    if not bot_token:
         raise ValueError("BOT_TOKEN environment variable is required")
-    if not ADMIN_ID:
+    if not admin_id:
         raise ValueError("ADMIN_ID environment variable is required")
+    if not use_polling and not public_host:
+        raise ValueError("PUBLIC_HOST environment variable is required unless USE_POLLING=1")
         
+    return Config(
+        BOT_TOKEN=bot_token,
+        ADMIN_ID=admin_id,
+        DB_PATH=db_path,
+        USE_POLLING=use_polling,
+        PUBLIC_HOST=public_host,
+        WEBHOOK_SECRET=webhook_secret,
+        PORT=port
+    )
+
+try:
+    CONFIG = _load()
 except ValueError as e:
-    logger.error(f"Configuration error: {e}")
+    logger.error("Configuration error: %s", e)
     sys.exit(1)
 except Exception as e:
-    logger.error(f"Unexpected configuration error: {e}")
+    logger.exception("Unexpected configuration error: %s", e)
     sys.exit(1)
 
+# Bind hot values as module globals so handlers skip the attribute lookup
+BOT_TOKEN = CONFIG.BOT_TOKEN
+ADMIN_ID = CONFIG.ADMIN_ID
+DB_PATH = CONFIG.DB_PATH
+
 # --- Database Setup ---
+# Seconds to wait on a locked database before failing
+DB_TIMEOUT = 5
+
 def init_db():
     """Initialize the database with proper error handling"""
     try:
@@ -51,265 +100,331 @@ def init_db():
                      status TEXT DEFAULT "pending",
                      timestamp TEXT NOT NULL,
                      created_at DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+        # status serves /pending (rowid order comes free with the index);
+        # (appeal_type, status, created_at) covers the grouped /stats query
+        c.executescript('''CREATE INDEX IF NOT EXISTS idx_appeals_status
+                           ON appeals (status);
+                           CREATE INDEX IF NOT EXISTS idx_appeals_type_status
+                           ON appeals (appeal_type, status, created_at);''')
         conn.commit()
         logger.info("Database initialized successfully")
     except sqlite3.Error as e:
-        logger.error(f"Database initialization error: {e}")
+        logger.exception("Database initialization error: %s", e)
         sys.exit(1)
     except Exception as e:
-        logger.error(f"Unexpected database error: {e}")
+        logger.exception("Unexpected database error: %s", e)
         sys.exit(1)
     finally:
         if conn:
             conn.close()
 
-def get_db_connection():
-    """Get database connection with error handling"""
+# Shared database connection, opened once before the bot starts receiving updates
+db = None
+
+async def open_db(application):
+    """Open the shared database connection and warm it up"""
+    global db
+    db = await aiosqlite.connect(DB_PATH, timeout=DB_TIMEOUT)
+    await db.execute_fetchall("SELECT 1")
+    logger.info("Database connection ready")
+
+async def close_db(application):
+    """Close the shared database connection on shutdown"""
+    if db:
+        await db.close()
+
+# Serializes write transactions on the shared connection, so one handler's
+# commit or rollback never covers another handler's uncommitted statement
+db_write_lock = asyncio.Lock()
+
+async def execute_write(query, params=()):
+    """Run a write statement and commit it, rolling back on failure; returns any RETURNING rows"""
+    async with db_write_lock:
+        try:
+            rows = await db.execute_fetchall(query, params)
+            await db.commit()
+        except sqlite3.Error:
+            await db.rollback()
+            raise
+    return rows
+
+def parse_appeal_id(raw):
+    """Parse an appeal ID argument such as '12' or '#12' into the integer row id"""
+    return int(raw.lstrip('#'))
+
+async def send_notification(bot, chat_id, text, sent_log, failure_reply=None):
+    """Send a notification from a background task; sent_log is a (format, *args) tuple logged on success"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        return conn
-    except sqlite3.Error as e:
-        logger.error(f"Database connection error: {e}")
-        return None
+        await bot.send_message(chat_id, text)
+        logger.info(*sent_log)
+    except TelegramError as e:
+        logger.error("Failed to notify %s: %s", chat_id, e)
+        if failure_reply:
+            await failure_reply()
+
+def chunk_messages(parts, limit=MessageLimit.MAX_TEXT_LENGTH):
+    """Join message parts into as few messages as possible without splitting a part"""
+    chunks, current, size = [], [], 0
+    for part in parts:
+        if current and size + len(part) > limit:
+            chunks.append("".join(current))
+            current, size = [], 0
+        current.append(part)
+        size += len(part)
+    if current:
+        chunks.append("".join(current))
+    return chunks
 
 # --- User Commands ---
-def start(update: Update, context: CallbackContext):
+# Appeal conversation states
+CHOOSING, WRITING = range(2)
+
+# Seconds of inactivity after which an unfinished appeal is dropped
+APPEAL_TIMEOUT = 900
+
+# Appeal type keyboard and prompts, built once at import
+APPEAL_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔓 Fed Unban Appeal", callback_data="unban")],
+    [InlineKeyboardButton("👑 Fed Admin Request", callback_data="admin")]
+])
+
+TEMPLATES = {
+    "unban": (
+        "✍️ Please write and submit your unban appeal.\n\n"
+        "📝 Please write your appeal in detail. Example:\n"
+        "1. Why were you banned?\n"
+        "2. What have you learned from this experience?\n"
+        "3. Why should we unban you?\n"
+        "4. Any additional information?\n\n"
+        "Type your appeal now:"
+    ),
+    "admin": (
+        "✍️ Please write and submit your admin request appeal.\n\n"
+        "📝 Please write your admin request. Example:\n"
+        "1. Why do you want to be an admin?\n"
+        "2. What experience do you have?\n"
+        "3. How will you help the community?\n"
+        "4. Any additional information?\n\n"
+        "Type your appeal now:"
+    )
+}
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start command handler"""
     try:
-        update.message.reply_text(
+        await update.message.reply_text(
             "📝 Welcome to the Appeals Bot!\n\n"
             "Use /appeal to submit a FedBan appeal or request Fed Admin status"
         )
-        logger.info(f"User {update.effective_user.id} started the bot")
+        logger.info("User %s started the bot", update.effective_user.id)
     except TelegramError as e:
-        logger.error(f"Error in start command: {e}")
+        logger.exception("Error in start command: %s", e)
     except Exception as e:
-        logger.error(f"Unexpected error in start command: {e}")
+        logger.exception("Unexpected error in start command: %s", e)
 
-def appeal(update: Update, context: CallbackContext):
+async def appeal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Appeal command handler"""
     try:
-        keyboard = [
-            [InlineKeyboardButton("🔓 Fed Unban Appeal", callback_data="unban")],
-            [InlineKeyboardButton("👑 Fed Admin Request", callback_data="admin")]
-        ]
-        update.message.reply_text(
+        await update.message.reply_text(
             "Select appeal type:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=APPEAL_KB
         )
-        logger.info(f"User {update.effective_user.id} requested appeal menu")
+        logger.info("User %s requested appeal menu", update.effective_user.id)
+        return CHOOSING
     except TelegramError as e:
-        logger.error(f"Error in appeal command: {e}")
-        update.message.reply_text("❌ An error occurred. Please try again later.")
+        logger.exception("Error in appeal command: %s", e)
+        await update.message.reply_text("❌ An error occurred. Please try again later.")
     except Exception as e:
-        logger.error(f"Unexpected error in appeal command: {e}")
-
-# Store temporary data for users writing appeals
-user_appeals = {}
+        logger.exception("Unexpected error in appeal command: %s", e)
 
-def handle_appeal_type(update: Update, context: CallbackContext):
+async def handle_appeal_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle appeal type selection"""
     try:
         query = update.callback_query
-        query.answer()
+        await query.answer()
         user = query.from_user
         
         # Validate appeal type
-        if query.data not in ['unban', 'admin']:
-            query.edit_message_text("❌ Invalid appeal type")
-            return
-        
-        # Store appeal type temporarily
-        user_appeals[user.id] = {'type': query.data}
+        template = TEMPLATES.get(query.data)
+        if template is None:
+            await query.edit_message_text("❌ Invalid appeal type")
+            return ConversationHandler.END
         
         # Ask for appeal text with template
-        appeal_type = "unban" if query.data == "unban" else "admin request"
-        template = ""
-        
-        if query.data == "unban":
-            template = (
-                "\n\n📝 Please write your appeal in detail. Example:\n"
-                "1. Why were you banned?\n"
-                "2. What have you learned from this experience?\n"
-                "3. Why should we unban you?\n"
-                "4. Any additional information?"
-            )
-        else:
-            template = (
-                "\n\n📝 Please write your admin request. Example:\n"
-                "1. Why do you want to be an admin?\n"
-                "2. What experience do you have?\n"
-                "3. How will you help the community?\n"
-                "4. Any additional information?"
-            )
-            
-        query.edit_message_text(
-            f"✍️ Please write and submit your {appeal_type} appeal.{template}\n\n"
-            "Type your appeal now:"
-        )
+        await query.edit_message_text(template)
         
-        # Set next step to handle appeal text
-        context.user_data['expecting_appeal_text'] = True
+        # Remember the type for the text step
         context.user_data['appeal_type'] = query.data
         
-        logger.info(f"User {user.id} selected {query.data} appeal type")
+        logger.info("User %s selected %s appeal type", user.id, query.data)
+        return WRITING
             
     except TelegramError as e:
-        logger.error(f"Telegram error in handle_appeal_type: {e}")
+        logger.exception("Telegram error in handle_appeal_type: %s", e)
     except Exception as e:
-        logger.error(f"Unexpected error in handle_appeal_type: {e}")
+        logger.exception("Unexpected error in handle_appeal_type: %s", e)
 
-def handle_appeal_text(update: Update, context: CallbackContext):
+async def handle_appeal_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle user's appeal text submission"""
     try:
-        if not context.user_data.get('expecting_appeal_text'):
-            return
-            
         user = update.message.from_user
         appeal_text = update.message.text
         appeal_type = context.user_data['appeal_type']
         
-        # Save to database
-        conn = get_db_connection()
-        if not conn:
-            update.message.reply_text("❌ Database error. Please try again later.")
-            return
-            
+        # Save to database; one clock read feeds both time columns and the admin message
+        now = datetime.now(timezone.utc)
+        created_at = now.strftime("%Y-%m-%d %H:%M:%S")
         try:
-            c = conn.cursor()
-            c.execute('''INSERT INTO appeals 
-                        (user_id, username, appeal_type, appeal_text, timestamp)
-                        VALUES (?, ?, ?, ?, ?)''',
+            rows = await execute_write('''INSERT INTO appeals 
+                        (user_id, username, appeal_type, appeal_text, timestamp, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?) RETURNING id''',
                      (user.id, user.username or 'No username', appeal_type, appeal_text,
-                      datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-            conn.commit()
-            appeal_id = c.lastrowid
+                      created_at, created_at))
+            appeal_id = rows[0][0]
             
-            update.message.reply_text(
+            await update.message.reply_text(
                 f"✅ {appeal_type.capitalize()} appeal submitted successfully!\n"
                 f"Appeal ID: #{appeal_id}\n\n"
                 "Your appeal will be reviewed by an admin."
             )
             
-            # Notify admin with detailed information
-            try:
-                context.bot.send_message(
-                    ADMIN_ID,
-                    f"🚨 New Appeal #{appeal_id}\n"
-                    f"User: @{user.username or 'No username'} (ID: {user.id})\n"
-                    f"Type: {appeal_type.capitalize()}\n"
-                    f"Time: {datetime.now().strftime('%H:%M %d-%m-%Y')}\n\n"
-                    f"📝 Appeal Text:\n{appeal_text}\n\n"
-                    f"Use /approve {appeal_id} to approve\n"
-                    f"Use /reject {appeal_id} to reject\n\n"
-                    f"Use /pending to view all pending appeals"
-                )
-                logger.info(f"Admin notified about appeal #{appeal_id}")
-            except TelegramError as e:
-                logger.error(f"Failed to notify admin: {e}")
+            # Notify admin with detailed information, without holding up the user
+            context.application.create_task(send_notification(
+                context.bot,
+                ADMIN_ID,
+                f"🚨 New Appeal #{appeal_id}\n"
+                f"User: @{user.username or 'No username'} (ID: {user.id})\n"
+                f"Type: {appeal_type.capitalize()}\n"
+                f"Time: {now.strftime('%H:%M %d-%m-%Y')} UTC\n\n"
+                f"📝 Appeal Text:\n{appeal_text}\n\n"
+                f"Use /approve {appeal_id} to approve\n"
+                f"Use /reject {appeal_id} to reject\n\n"
+                f"Use /pending to view all pending appeals",
+                ("Admin notified about appeal #%s", appeal_id)
+            ))
                 
-            logger.info(f"Appeal #{appeal_id} submitted by user {user.id}")
+            logger.info("Appeal #%s submitted by user %s", appeal_id, user.id)
             
             # Clean up user data
-            del context.user_data['expecting_appeal_text']
             del context.user_data['appeal_type']
-            if user.id in user_appeals:
-                del user_appeals[user.id]
+            return ConversationHandler.END
                 
         except sqlite3.Error as e:
-            logger.error(f"Database error in handle_appeal_text: {e}")
-            update.message.reply_text("❌ Database error. Please try again later.")
-        finally:
-            conn.close()
+            logger.exception("Database error in handle_appeal_text: %s", e)
+            await update.message.reply_text("❌ Database error. Please try again later.")
             
     except TelegramError as e:
-        logger.error(f"Telegram error in handle_appeal_text: {e}")
+        logger.exception("Telegram error in handle_appeal_text: %s", e)
     except Exception as e:
-        logger.error(f"Unexpected error in handle_appeal_text: {e}")
+        logger.exception("Unexpected error in handle_appeal_text: %s", e)
+
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel an appeal in progress"""
+    context.user_data.pop('appeal_type', None)
+    try:
+        await update.message.reply_text("❎ Appeal cancelled. Use /appeal to start again.")
+        logger.info("User %s cancelled their appeal", update.effective_user.id)
+    except TelegramError as e:
+        logger.exception("Error in cancel command: %s", e)
+    return ConversationHandler.END
+
+async def stale_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Answer presses on an appeal menu that no longer belongs to an active appeal"""
+    try:
+        query = update.callback_query
+        await query.answer()
+        await query.edit_message_text("⌛ This appeal menu has expired. Use /appeal to start again.")
+    except TelegramError as e:
+        logger.exception("Error in stale_callback: %s", e)
+
+async def appeal_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Drop the state of an appeal abandoned for APPEAL_TIMEOUT seconds"""
+    context.user_data.pop('appeal_type', None)
+    logger.info("Appeal flow of user %s timed out", update.effective_user.id)
 
 # --- Admin Commands ---
-def pending(update: Update, context: CallbackContext):
+STATS_TEMPLATE = (
+    "📊 <b>Appeal Statistics</b>\n\n"
+    "<b>Total Appeals:</b> {total}\n"
+    "<b>Pending:</b> {pending}\n"
+    "<b>Approved:</b> {approved}\n"
+    "<b>Rejected:</b> {rejected}\n\n"
+    "<b>Recent Activity:</b>\n"
+    "• Last 24h: {last_24h}\n"
+    "• Last 7 days: {last_7d}\n\n"
+    "<b>By Appeal Type:</b>\n"
+    "{type_stats}\n\n"
+    "Use /pending to view pending appeals"
+)
+
+async def access_denied(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Reply to admin commands sent by anyone else"""
+    try:
+        await update.message.reply_text("❌ Access denied.")
+    except TelegramError as e:
+        logger.exception("Error in access_denied: %s", e)
+
+async def pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show pending appeals (admin only)"""
     try:
-        if update.effective_user.id != ADMIN_ID:
-            update.message.reply_text("❌ Access denied.")
-            return
-            
-        conn = get_db_connection()
-        if not conn:
-            update.message.reply_text("❌ Database error. Please try again later.")
-            return
-            
         try:
-            c = conn.cursor()
-            c.execute("SELECT * FROM appeals WHERE status='pending' ORDER BY id DESC")
-            appeals = c.fetchall()
+            # Only the columns shown, with the text preview truncated by SQLite
+            c = await db.execute(
+                """SELECT id, user_id, username, appeal_type, substr(appeal_text, 1, 100), status, created_at
+                   FROM appeals WHERE status='pending' ORDER BY id DESC"""
+            )
+            appeals = await c.fetchall()
             
             if not appeals:
-                update.message.reply_text("📋 No pending appeals!")
+                await update.message.reply_text("📋 No pending appeals!")
                 return
             
-            response = "📋 Pending Appeals:\n\n"
+            parts = ["📋 Pending Appeals:\n\n"]
             for appeal in appeals:
-                response += (
+                parts.append(
                     f"ID: #{appeal[0]}\n"
                     f"User: @{appeal[2]} (ID: {appeal[1]})\n"
                     f"Type: {appeal[3].capitalize()}\n"
-                    f"Time: {appeal[6]}\n"
+                    f"Time: {appeal[6]} UTC\n"
                     f"Status: {appeal[5]}\n"
-                    f"Text: {appeal[4][:100]}...\n"
+                    f"Text: {appeal[4]}...\n"
                     "───────────────\n"
                 )
             
-            # Split long messages if needed
-            if len(response) > 4096:
-                for i in range(0, len(response), 4096):
-                    update.message.reply_text(response[i:i+4096])
-            else:
-                update.message.reply_text(response)
+            # Split long listings between appeals, never inside one
+            for chunk in chunk_messages(parts):
+                await update.message.reply_text(chunk)
                 
-            logger.info(f"Admin {update.effective_user.id} viewed pending appeals")
+            logger.info("Admin %s viewed pending appeals", update.effective_user.id)
             
         except sqlite3.Error as e:
-            logger.error(f"Database error in pending: {e}")
-            update.message.reply_text("❌ Database error. Please try again later.")
-        finally:
-            conn.close()
+            logger.exception("Database error in pending: %s", e)
+            await update.message.reply_text("❌ Database error. Please try again later.")
             
     except TelegramError as e:
-        logger.error(f"Telegram error in pending: {e}")
+        logger.exception("Telegram error in pending: %s", e)
     except Exception as e:
-        logger.error(f"Unexpected error in pending: {e}")
+        logger.exception("Unexpected error in pending: %s", e)
 
-def view_appeal(update: Update, context: CallbackContext):
+async def view_appeal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """View full appeal details (admin only)"""
     try:
-        if update.effective_user.id != ADMIN_ID:
-            update.message.reply_text("❌ Access denied.")
-            return
-            
         if not context.args:
-            update.message.reply_text("❌ Usage: /view <appeal_id>")
+            await update.message.reply_text("❌ Usage: /view <appeal_id>")
             return
             
         try:
-            appeal_id = int(context.args[0])
+            appeal_id = parse_appeal_id(context.args[0])
         except ValueError:
-            update.message.reply_text("❌ Invalid appeal ID. Please provide a number.")
-            return
-            
-        conn = get_db_connection()
-        if not conn:
-            update.message.reply_text("❌ Database error. Please try again later.")
+            await update.message.reply_text("❌ Invalid appeal ID. Please provide a number.")
             return
             
         try:
-            c = conn.cursor()
-            c.execute("SELECT * FROM appeals WHERE id=?", (appeal_id,))
-            appeal = c.fetchone()
+            c = await db.execute("SELECT * FROM appeals WHERE id=?", (appeal_id,))
+            appeal = await c.fetchone()
             
             if not appeal:
-                update.message.reply_text(f"❌ Appeal #{appeal_id} not found.")
+                await update.message.reply_text(f"❌ Appeal #{appeal_id} not found.")
                 return
                 
             response = (
@@ -317,271 +432,275 @@ def view_appeal(update: Update, context: CallbackContext):
                 f"User: @{appeal[2]} (ID: {appeal[1]})\n"
                 f"Type: {appeal[3].capitalize()}\n"
                 f"Status: {appeal[5]}\n"
-                f"Time: {appeal[6]}\n\n"
+                f"Time: {appeal[7]} UTC\n\n"
                 f"📝 Appeal Text:\n{appeal[4]}\n\n"
                 f"Use /approve {appeal[0]} to approve\n"
                 f"Use /reject {appeal[0]} to reject"
             )
             
-            update.message.reply_text(response)
-            logger.info(f"Admin viewed appeal #{appeal_id}")
+            await update.message.reply_text(response)
+            logger.info("Admin viewed appeal #%s", appeal_id)
             
         except sqlite3.Error as e:
-            logger.error(f"Database error in view_appeal: {e}")
-            update.message.reply_text("❌ Database error. Please try again later.")
-        finally:
-            conn.close()
+            logger.exception("Database error in view_appeal: %s", e)
+            await update.message.reply_text("❌ Database error. Please try again later.")
             
     except TelegramError as e:
-        logger.error(f"Telegram error in view_appeal: {e}")
+        logger.exception("Telegram error in view_appeal: %s", e)
     except Exception as e:
-        logger.error(f"Unexpected error in view_appeal: {e}")
+        logger.exception("Unexpected error in view_appeal: %s", e)
 
-def approve(update: Update, context: CallbackContext):
+async def approve(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Approve appeal (admin only)"""
     try:
-        if update.effective_user.id != ADMIN_ID:
-            update.message.reply_text("❌ Access denied.")
-            return
-            
         if not context.args:
-            update.message.reply_text("❌ Usage: /approve <appeal_id>")
+            await update.message.reply_text("❌ Usage: /approve <appeal_id>")
             return
             
         try:
-            appeal_id = int(context.args[0])
+            appeal_id = parse_appeal_id(context.args[0])
         except ValueError:
-            update.message.reply_text("❌ Invalid appeal ID. Please provide a number.")
-            return
-            
-        conn = get_db_connection()
-        if not conn:
-            update.message.reply_text("❌ Database error. Please try again later.")
+            await update.message.reply_text("❌ Invalid appeal ID. Please provide a number.")
             return
             
         try:
-            c = conn.cursor()
-            
-            # Check if appeal exists
-            c.execute("SELECT user_id, appeal_type, appeal_text FROM appeals WHERE id=? AND status='pending'", (appeal_id,))
-            result = c.fetchone()
+            # Update the appeal if it is still pending, returning only the fields we need
+            result = await execute_write(
+                """UPDATE appeals SET status='approved' WHERE id=? AND status='pending'
+                   RETURNING user_id, appeal_type, appeal_text""",
+                (appeal_id,)
+            )
             
             if not result:
-                update.message.reply_text(f"❌ Appeal #{appeal_id} not found or already processed.")
+                await update.message.reply_text(f"❌ Appeal #{appeal_id} not found or already processed.")
                 return
                 
-            user_id, appeal_type, appeal_text = result
-            
-            # Update database
-            c.execute("UPDATE appeals SET status='approved' WHERE id=?", (appeal_id,))
-            conn.commit()
+            user_id, appeal_type, appeal_text = result[0]
             
-            update.message.reply_text(f"✅ Appeal #{appeal_id} approved successfully!")
+            await update.message.reply_text(f"✅ Appeal #{appeal_id} approved successfully!")
             
-            # Notify user
-            try:
-                context.bot.send_message(
-                    user_id, 
-                    f"🎉 Your {appeal_type} appeal has been approved!\n"
-                    f"Appeal ID: #{appeal_id}\n\n"
-                    f"Your appeal text:\n{appeal_text}"
-                )
-                logger.info(f"User {user_id} notified about approved appeal #{appeal_id}")
-            except TelegramError as e:
-                logger.error(f"Failed to notify user {user_id}: {e}")
-                update.message.reply_text(f"Appeal approved but failed to notify user.")
+            # Notify user in the background
+            context.application.create_task(send_notification(
+                context.bot,
+                user_id,
+                f"🎉 Your {appeal_type} appeal has been approved!\n"
+                f"Appeal ID: #{appeal_id}\n\n"
+                f"Your appeal text:\n{appeal_text}",
+                ("User %s notified about approved appeal #%s", user_id, appeal_id),
+                failure_reply=partial(update.message.reply_text, "Appeal approved but failed to notify user.")
+            ))
                 
-            logger.info(f"Appeal #{appeal_id} approved by admin {update.effective_user.id}")
+            logger.info("Appeal #%s approved by admin %s", appeal_id, update.effective_user.id)
             
         except sqlite3.Error as e:
-            logger.error(f"Database error in approve: {e}")
-            update.message.reply_text("❌ Database error. Please try again later.")
-        finally:
-            conn.close()
+            logger.exception("Database error in approve: %s", e)
+            await update.message.reply_text("❌ Database error. Please try again later.")
             
     except TelegramError as e:
-        logger.error(f"Telegram error in approve: {e}")
+        logger.exception("Telegram error in approve: %s", e)
     except Exception as e:
-        logger.error(f"Unexpected error in approve: {e}")
+        logger.exception("Unexpected error in approve: %s", e)
 
-def reject(update: Update, context: CallbackContext):
+async def reject(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Reject appeal (admin only)"""
     try:
-        if update.effective_user.id != ADMIN_ID:
-            update.message.reply_text("❌ Access denied.")
-            return
-            
         if not context.args:
-            update.message.reply_text("❌ Usage: /reject <appeal_id>")
+            await update.message.reply_text("❌ Usage: /reject <appeal_id>")
             return
             
         try:
-            appeal_id = int(context.args[0])
+            appeal_id = parse_appeal_id(context.args[0])
         except ValueError:
-            update.message.reply_text("❌ Invalid appeal ID. Please provide a number.")
-            return
-            
-        conn = get_db_connection()
-        if not conn:
-            update.message.reply_text("❌ Database error. Please try again later.")
+            await update.message.reply_text("❌ Invalid appeal ID. Please provide a number.")
             return
             
         try:
-            c = conn.cursor()
-            
-            # Check if appeal exists
-            c.execute("SELECT user_id, appeal_type, appeal_text FROM appeals WHERE id=? AND status='pending'", (appeal_id,))
-            result = c.fetchone()
+            # Update the appeal if it is still pending, returning only the fields we need
+            result = await execute_write(
+                """UPDATE appeals SET status='rejected' WHERE id=? AND status='pending'
+                   RETURNING user_id, appeal_type, appeal_text""",
+                (appeal_id,)
+            )
             
             if not result:
-                update.message.reply_text(f"❌ Appeal #{appeal_id} not found or already processed.")
+                await update.message.reply_text(f"❌ Appeal #{appeal_id} not found or already processed.")
                 return
                 
-            user_id, appeal_type, appeal_text = result
-            
-            # Update database
-            c.execute("UPDATE appeals SET status='rejected' WHERE id=?", (appeal_id,))
-            conn.commit()
-            
-            update.message.reply_text(f"❌ Appeal #{appeal_id} rejected.")
-            
-            # Notify user
-            try:
-                context.bot.send_message(
-                    user_id, 
-                    f"❌ Your {appeal_type} appeal has been rejected.\n"
-                    f"Appeal ID: #{appeal_id}\n\n"
-                    f"Your appeal text:\n{appeal_text}\n\n"
-                    "You may submit a new appeal if you wish."
-                )
-                logger.info(f"User {user_id} notified about rejected appeal #{appeal_id}")
-            except TelegramError as e:
-                logger.error(f"Failed to notify user {user_id}: {e}")
-                update.message.reply_text(f"Appeal rejected but failed to notify user.")
+            user_id, appeal_type, appeal_text = result[0]
+            
+            await update.message.reply_text(f"❌ Appeal #{appeal_id} rejected.")
+            
+            # Notify user in the background
+            context.application.create_task(send_notification(
+                context.bot,
+                user_id,
+                f"❌ Your {appeal_type} appeal has been rejected.\n"
+                f"Appeal ID: #{appeal_id}\n\n"
+                f"Your appeal text:\n{appeal_text}\n\n"
+                "You may submit a new appeal if you wish.",
+                ("User %s notified about rejected appeal #%s", user_id, appeal_id),
+                failure_reply=partial(update.message.reply_text, "Appeal rejected but failed to notify user.")
+            ))
                 
-            logger.info(f"Appeal #{appeal_id} rejected by admin {update.effective_user.id}")
+            logger.info("Appeal #%s rejected by admin %s", appeal_id, update.effective_user.id)
             
         except sqlite3.Error as e:
-            logger.error(f"Database error in reject: {e}")
-            update.message.reply_text("❌ Database error. Please try again later.")
-        finally:
-            conn.close()
+            logger.exception("Database error in reject: %s", e)
+            await update.message.reply_text("❌ Database error. Please try again later.")
             
     except TelegramError as e:
-        logger.error(f"Telegram error in reject: {e}")
+        logger.exception("Telegram error in reject: %s", e)
     except Exception as e:
-        logger.error(f"Unexpected error in reject: {e}")
+        logger.exception("Unexpected error in reject: %s", e)
 
-def stats(update: Update, context: CallbackContext):
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show appeal statistics (admin only)"""
     try:
-        if update.effective_user.id != ADMIN_ID:
-            update.message.reply_text("❌ Access denied.")
-            return
-            
-        conn = get_db_connection()
-        if not conn:
-            update.message.reply_text("❌ Database error. Please try again later.")
-            return
-            
         try:
-            c = conn.cursor()
-            
-            # Get basic stats
-            c.execute("SELECT COUNT(*) FROM appeals")
-            total = c.fetchone()[0]
-            
-            c.execute("SELECT COUNT(*) FROM appeals WHERE status='pending'")
-            pending = c.fetchone()[0]
-            
-            c.execute("SELECT COUNT(*) FROM appeals WHERE status='approved'")
-            approved = c.fetchone()[0]
-            
-            c.execute("SELECT COUNT(*) FROM appeals WHERE status='rejected'")
-            rejected = c.fetchone()[0]
+            # Compute the activity cutoffs from a single clock read
+            now = datetime.now(timezone.utc)
+            cutoff_1d = (now - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+            cutoff_7d = (now - timedelta(days=7)).strftime("%Y-%m-%d %H:%M:%S")
+            
+            # Collect every counter in a single pass, grouped by appeal type.
+            # The index holds every column used, so the table itself is never read.
+            by_type = await db.execute_fetchall(
+                """SELECT appeal_type, COUNT(*),
+                          SUM(status='pending'), SUM(status='approved'), SUM(status='rejected'),
+                          SUM(created_at >= ?), SUM(created_at >= ?)
+                   FROM appeals INDEXED BY idx_appeals_type_status
+                   GROUP BY appeal_type""",
+                (cutoff_1d, cutoff_7d)
+            )
+            totals = [sum(column) for column in zip(*(row[1:] for row in by_type))] or [0] * 6
+            values = dict(zip(("total", "pending", "approved", "rejected", "last_24h", "last_7d"), totals))
             
             # Get appeal type distribution
-            c.execute("SELECT appeal_type, COUNT(*) FROM appeals GROUP BY appeal_type")
-            type_stats = "\n".join([f"• {row[0].capitalize()}: {row[1]}" for row in c.fetchall()])
+            values["type_stats"] = "\n".join([f"• {row[0].capitalize()}: {row[1]}" for row in by_type])
             
-            # Get recent activity
-            c.execute("SELECT COUNT(*) FROM appeals WHERE created_at >= datetime('now', '-1 day')")
-            last_24h = c.fetchone()[0]
-            
-            c.execute("SELECT COUNT(*) FROM appeals WHERE created_at >= datetime('now', '-7 days')")
-            last_7d = c.fetchone()[0]
-            
-            response = (
-                "📊 <b>Appeal Statistics</b>\n\n"
-                f"<b>Total Appeals:</b> {total}\n"
-                f"<b>Pending:</b> {pending}\n"
-                f"<b>Approved:</b> {approved}\n"
-                f"<b>Rejected:</b> {rejected}\n\n"
-                f"<b>Recent Activity:</b>\n"
-                f"• Last 24h: {last_24h}\n"
-                f"• Last 7 days: {last_7d}\n\n"
-                f"<b>By Appeal Type:</b>\n"
-                f"{type_stats}\n\n"
-                "Use /pending to view pending appeals"
-            )
-            
-            update.message.reply_text(response, parse_mode='HTML')
-            logger.info(f"Admin {update.effective_user.id} viewed statistics")
+            await update.message.reply_text(STATS_TEMPLATE.format_map(values), parse_mode='HTML')
+            logger.info("Admin %s viewed statistics", update.effective_user.id)
             
         except sqlite3.Error as e:
-            logger.error(f"Database error in stats: {e}")
-            update.message.reply_text("❌ Database error. Please try again later.")
-        finally:
-            conn.close()
+            logger.exception("Database error in stats: %s", e)
+            await update.message.reply_text("❌ Database error. Please try again later.")
             
     except TelegramError as e:
-        logger.error(f"Telegram error in stats: {e}")
+        logger.exception("Telegram error in stats: %s", e)
     except Exception as e:
-        logger.error(f"Unexpected error in stats: {e}")
+        logger.exception("Unexpected error in stats: %s", e)
 
-def error_handler(update: Update, context: CallbackContext):
+async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Global error handler"""
-    logger.error(f"Update {update} caused error {context.error}")
+    logger.error("Update %s caused error %s", update, context.error)
 
 # --- Bot Setup ---
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Process updates concurrently, but one at a time per (chat, user) pair"""
+    # Per-pair ordering is what the appeal ConversationHandler relies on
+    __slots__ = ("_locks",)
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        if isinstance(update, Update):
+            key = (
+                update.effective_chat.id if update.effective_chat else None,
+                update.effective_user.id if update.effective_user else None
+            )
+        else:
+            key = None
+        # [lock, number of updates holding or waiting on it]; dropped when unused
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# Updates processed at once across all users
+MAX_CONCURRENT_UPDATES = 256
+
 def main():
     """Main function to run the bot"""
     try:
         # Initialize database
         init_db()
         
-        # Create updater
-        updater = Updater(BOT_TOKEN, use_context=True)
-        dp = updater.dispatcher
+        # Create application
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .post_init(open_db)
+            .post_shutdown(close_db)
+            .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+            .build()
+        )
         
         # User commands
-        dp.add_handler(CommandHandler("start", start))
-        dp.add_handler(CommandHandler("appeal", appeal))
+        application.add_handler(CommandHandler("start", start))
         
-        # Admin commands
-        dp.add_handler(CommandHandler("pending", pending))
-        dp.add_handler(CommandHandler("view", view_appeal))
-        dp.add_handler(CommandHandler("approve", approve))
-        dp.add_handler(CommandHandler("reject", reject))
-        dp.add_handler(CommandHandler("stats", stats))
+        # Appeal flow: type selection, then appeal text. The flow is tracked per
+        # chat and user on purpose, so PTB's per_message advice does not apply.
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="If 'per_message=False'", category=PTBUserWarning)
+            appeal_flow = ConversationHandler(
+                entry_points=[CommandHandler("appeal", appeal)],
+                states={
+                    CHOOSING: [CallbackQueryHandler(handle_appeal_type)],
+                    WRITING: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_appeal_text)],
+                    ConversationHandler.TIMEOUT: [TypeHandler(Update, appeal_timeout)]
+                },
+                fallbacks=[CommandHandler("cancel", cancel)],
+                allow_reentry=True,
+                conversation_timeout=APPEAL_TIMEOUT
+            )
+        application.add_handler(appeal_flow)
         
-        # Callbacks
-        dp.add_handler(CallbackQueryHandler(handle_appeal_type))
+        # Buttons on menus whose appeal has ended or timed out
+        application.add_handler(CallbackQueryHandler(stale_callback))
         
-        # Text handler for appeal submission
-        dp.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_appeal_text))
+        # Admin commands, restricted to the admin by filter
+        admin_filter = filters.User(user_id=ADMIN_ID)
+        application.add_handler(CommandHandler("pending", pending, filters=admin_filter))
+        application.add_handler(CommandHandler("view", view_appeal, filters=admin_filter))
+        application.add_handler(CommandHandler("approve", approve, filters=admin_filter))
+        application.add_handler(CommandHandler("reject", reject, filters=admin_filter))
+        application.add_handler(CommandHandler("stats", stats, filters=admin_filter))
+        application.add_handler(CommandHandler(["pending", "view", "approve", "reject", "stats"], access_denied))
         
         # Error handler
-        dp.add_error_handler(error_handler)
+        application.add_error_handler(error_handler)
         
         logger.info("Bot started successfully")
         print("Bot is running...")
         
-        updater.start_polling()
-        updater.idle()
+        if CONFIG.USE_POLLING:
+            # Local development fallback
+            application.run_polling()
+        else:
+            # Telegram pushes updates to us; the process idles between them
+            application.run_webhook(
+                listen="0.0.0.0",
+                port=CONFIG.PORT,
+                url_path=BOT_TOKEN,
+                webhook_url=f"https://{CONFIG.PUBLIC_HOST}/{BOT_TOKEN}",
+                secret_token=CONFIG.WEBHOOK_SECRET
+            )
         
     except Exception as e:
-        logger.error(f"Failed to start bot: {e}")
+        logger.exception("Failed to start bot: %s", e)
         sys.exit(1)
 
 if __name__ == '__main__':